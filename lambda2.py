@@ -4,21 +4,33 @@ Procesa señales ECG + Acelerómetro
 """
 
 import json
+import zlib
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
 import os
+import logging
 import struct
+from functools import lru_cache
 import numpy as np
 import pywt
 from datetime import datetime
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from io import BytesIO, StringIO
+from io import BytesIO, RawIOBase
+from concurrent.futures import ThreadPoolExecutor, wait
 from scipy import signal
-import csv
+from scipy.ndimage import uniform_filter1d
 
-# Clientes AWS
-s3_client = boto3.client('s3')
+# Clientes AWS (a nivel de módulo para reutilizar conexiones entre invocaciones)
+AWS_CLIENT_CONFIG = Config(
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    max_pool_connections=50
+)
+s3_client = boto3.client('s3', config=AWS_CLIENT_CONFIG)
+
+# Logger del runtime de Lambda (formatea argumentos solo si el nivel está habilitado)
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
 
 # Configuración
 OUTPUT_BUCKET = os.environ.get('OUTPUT_BUCKET', 'holter-processed-data')
@@ -32,6 +44,72 @@ ACCEL_SCALE = 16.0 / 32768.0  # Solo acelerómetro
 ECG_SAMPLE_RATE_HZ = 250
 IMU_SAMPLE_RATE_HZ = 50  # Ajustado a 50Hz para reducir I2C
 
+# Piso de ruido (mV) bajo el cual una derivación sin movimiento no se filtra con wavelets
+NOISE_FLOOR_MV = 0.02
+
+# Pools de hilos (a nivel de módulo para reutilizar los hilos entre invocaciones)
+WORKER_POOL = ThreadPoolExecutor(max_workers=4)  # derivaciones ECG y gráficos
+UPLOAD_POOL = ThreadPoolExecutor(max_workers=8)  # subidas a S3
+
+# Gráficos: puntos máximos por traza y resolución de salida
+PLOT_MAX_POINTS = 4000
+PLOT_DPI = 100
+
+# CSV: filas formateadas por bloque y nivel gzip del stream subido a S3
+CSV_CHUNK_ROWS = 10000
+CSV_GZIP_LEVEL = 3
+
+# Subida multipart del CSV: limita las partes de 8 MB retenidas en memoria (stream no seekable)
+CSV_TRANSFER_CONFIG = TransferConfig(multipart_chunksize=8 * 1024 * 1024, max_concurrency=2)
+# TransferConfig no acepta este parámetro en el constructor, pero s3transfer lo lee como atributo
+CSV_TRANSFER_CONFIG.max_in_memory_upload_chunks = 2
+
+# Header binario: magic(4) + version(2) + device_id(2) + session_id(4) + timestamp(4) +
+# ecg_rate(2) + imu_rate(2) + num_ecg(4) + num_imu(4) = 28 bytes
+HEADER_STRUCT = struct.Struct('<IHHIIHHII')
+
+# Banco de filtros wavelet (se construye una sola vez)
+WAVELET = pywt.Wavelet('db4')
+
+
+@lru_cache(maxsize=32)
+def universal_threshold_factor(n):
+    """Factor sqrt(2*ln(N)) del umbral universal, cacheado por longitud"""
+    # float de Python: no promueve los umbrales float32 a float64 (NEP 50)
+    return float(np.sqrt(2 * np.log(n)))
+
+
+@lru_cache(maxsize=32)
+def notch_sos(f0, Q, fs):
+    """Secciones de segundo orden del filtro notch, diseñadas una vez por (f0, Q, fs)"""
+    b, a = signal.iirnotch(f0, Q, fs)
+    return signal.tf2sos(b, a)
+
+
+@lru_cache(maxsize=32)
+def butter_sos(order, normalized_cutoff, btype):
+    """Secciones de segundo orden Butterworth, diseñadas una vez por (orden, corte, tipo)"""
+    return signal.butter(order, normalized_cutoff, btype=btype, output='sos')
+
+
+def soft_threshold_inplace(coeffs, threshold, scratch=None):
+    """
+    Umbral suave sign(c)*max(|c|-t, 0) escrito sobre el mismo array
+    scratch: buffer opcional (mismo shape que coeffs) para la magnitud
+    """
+    magnitude = np.abs(coeffs, out=scratch)
+    np.subtract(magnitude, threshold, out=magnitude)
+    np.maximum(magnitude, 0, out=magnitude)
+    np.copysign(magnitude, coeffs, out=coeffs)
+    return coeffs
+
+
+def acceleration_magnitude(accel_data):
+    """Magnitud |a| de un array (N, 3): producto punto por fila + raíz en el mismo buffer"""
+    magnitude = np.einsum('ij,ij->i', accel_data, accel_data)
+    np.sqrt(magnitude, out=magnitude)
+    return magnitude
+
 
 class SignalProcessor:
     """Procesador de señales ECG/IMU"""
@@ -50,8 +128,8 @@ class SignalProcessor:
             print(f"[WARNING] Frecuencia notch {f0}Hz >= Nyquist {fs/2}Hz, saltando filtro")
             return signal_data
         
-        b, a = signal.iirnotch(f0, Q, fs)
-        filtered = signal.filtfilt(b, a, signal_data)
+        sos = notch_sos(f0, Q, fs)
+        filtered = signal.sosfiltfilt(sos, signal_data, axis=-1)
         return filtered
     
     def highpass_filter(self, signal_data, cutoff, fs, order=4):
@@ -63,8 +141,8 @@ class SignalProcessor:
             print(f"[WARNING] HPF cutoff inválido: {normalized_cutoff:.4f}, saltando")
             return signal_data
         
-        b, a = signal.butter(order, normalized_cutoff, btype='high')
-        filtered = signal.filtfilt(b, a, signal_data)
+        sos = butter_sos(order, normalized_cutoff, 'high')
+        filtered = signal.sosfiltfilt(sos, signal_data, axis=-1)
         return filtered
     
     def lowpass_filter(self, signal_data, cutoff, fs, order=4):
@@ -76,8 +154,8 @@ class SignalProcessor:
             print(f"[WARNING] LPF cutoff inválido: {normalized_cutoff:.4f}, ajustando a 0.95")
             normalized_cutoff = 0.95
         
-        b, a = signal.butter(order, normalized_cutoff, btype='low')
-        filtered = signal.filtfilt(b, a, signal_data)
+        sos = butter_sos(order, normalized_cutoff, 'low')
+        filtered = signal.sosfiltfilt(sos, signal_data, axis=-1)
         return filtered
     
     def preprocess_ecg(self, ecg_signal):
@@ -86,11 +164,12 @@ class SignalProcessor:
         1. Filtro pasa-altos 0.5Hz (elimina drift)
         2. Filtro pasa-bajos 100Hz (elimina ruido HF)
         3. Filtro notch 60Hz (elimina ruido eléctrico)
+        ecg_signal: (N,) o (L, N) - se filtra a lo largo del último eje
         """
         fs = self.ecg_sample_rate
         nyquist = fs / 2
         
-        print(f"[PREPROCESS] fs={fs}Hz, Nyquist={nyquist}Hz, señal length={len(ecg_signal)}")
+        print(f"[PREPROCESS] fs={fs}Hz, Nyquist={nyquist}Hz, señal length={ecg_signal.shape[-1]}")
         
         # Paso 1: HPF 0.5 Hz
         ecg_hpf = self.highpass_filter(ecg_signal, cutoff=0.5, fs=fs)
@@ -109,28 +188,41 @@ class SignalProcessor:
         
         return ecg_filtered
     
-    def adaptive_wavelet_filter(self, sig, wavelet='db4', level=5, threshold_scale=1.5):
-        """Filtrado wavelet adaptativo para ECG"""
-        if len(sig) < 2**level:
-            level = max(1, int(np.log2(len(sig))) - 1)
+    def adaptive_wavelet_filter(self, sig, wavelet=WAVELET, level=5, threshold_scale=1.5):
+        """
+        Filtrado wavelet adaptativo para ECG
+        sig: (N,) o (L, N) - con 2-D se filtran todas las derivaciones en una
+        sola descomposición (axis=-1) con umbral independiente por derivación
+        threshold_scale: escalar o array (N,) con la escala por muestra; en ese
+        caso se mapea a la longitud de cada nivel de coeficientes
+        """
+        n = sig.shape[-1]
+        if n < 2**level:
+            level = max(1, int(np.log2(n)) - 1)
         
-        coeffs = pywt.wavedec(sig, wavelet, level=level)
+        coeffs = pywt.wavedec(sig, wavelet, level=level, axis=-1)
         
-        sigma = np.median(np.abs(coeffs[-1])) / 0.6745
-        threshold = threshold_scale * sigma * np.sqrt(2 * np.log(len(sig)))
+        # |d1| se ordena en el mismo buffer para la mediana y luego sirve de
+        # scratch para todos los niveles (d1 es el nivel de detalle más largo)
+        scratch = np.abs(coeffs[-1])
+        sigma = np.median(scratch, axis=-1, overwrite_input=True) / 0.6745
+        base_threshold = sigma[..., np.newaxis] * universal_threshold_factor(n)
+        # Umbrales en el dtype de los coeficientes (float32): sin temporales float64 ni casts por elemento
+        threshold_scale = np.asarray(threshold_scale, dtype=scratch.dtype)
         
-        coeffs_filtered = [coeffs[0]]
         for i in range(1, len(coeffs)):
-            coeffs_filtered.append(pywt.threshold(coeffs[i], threshold, mode='soft'))
-        
-        filtered_signal = pywt.waverec(coeffs_filtered, wavelet)
-        
-        if len(filtered_signal) > len(sig):
-            filtered_signal = filtered_signal[:len(sig)]
-        elif len(filtered_signal) < len(sig):
-            filtered_signal = np.pad(filtered_signal, (0, len(sig) - len(filtered_signal)))
+            n_coeffs = coeffs[i].shape[-1]
+            if threshold_scale.ndim > 0:
+                # Escala por muestra -> escala por coeficiente (vecino más cercano)
+                idx = (np.arange(n_coeffs) * n) // n_coeffs
+                level_scale = threshold_scale[idx]
+            else:
+                level_scale = threshold_scale
+            soft_threshold_inplace(coeffs[i], level_scale * base_threshold, scratch=scratch[..., :n_coeffs])
         
-        return filtered_signal
+        # waverec devuelve n o n+1 muestras (longitudes impares): recorte como vista, sin copia
+        filtered_signal = pywt.waverec(coeffs, wavelet, axis=-1)
+        return filtered_signal[..., :n]
     
     def detect_motion_segments(self, accel_data, window_size=50, threshold=0.3):
         """
@@ -143,18 +235,21 @@ class SignalProcessor:
             # Retornar array vacío que será manejado correctamente
             return np.array([], dtype=bool)
         
-        accel_magnitude = np.sqrt(np.sum(accel_data**2, axis=1))
+        accel_magnitude = acceleration_magnitude(accel_data)
         
         if len(accel_magnitude) >= window_size:
-            accel_smooth = np.convolve(accel_magnitude, np.ones(window_size)/window_size, mode='same')
+            # Media móvil O(N) (ventana centrada, bordes replicados)
+            accel_detrended = uniform_filter1d(accel_magnitude, size=window_size, mode='nearest')
         else:
-            accel_smooth = accel_magnitude
+            accel_detrended = accel_magnitude.copy()
         
-        accel_detrended = np.abs(accel_magnitude - accel_smooth)
+        # |magnitud - media| escrito sobre el buffer de la media
+        np.subtract(accel_magnitude, accel_detrended, out=accel_detrended)
+        np.abs(accel_detrended, out=accel_detrended)
         motion_indicator = accel_detrended > threshold
         
         if len(motion_indicator) > 0:
-            motion_pct = (motion_indicator.sum() / len(motion_indicator)) * 100
+            motion_pct = (np.count_nonzero(motion_indicator) / len(motion_indicator)) * 100
             print(f"[MOTION] {motion_pct:.1f}% del tiempo en movimiento")
         else:
             print("[MOTION] Sin datos de movimiento")
@@ -172,7 +267,12 @@ class SignalProcessor:
         if original_length == target_length:
             return motion_mask
         
-        indices = np.linspace(0, original_length - 1, target_length).astype(int)
+        # Tasas múltiplo entero (250 Hz / 50 Hz): cada muestra IMU cubre `ratio` muestras ECG
+        if target_length % original_length == 0:
+            return motion_mask.repeat(target_length // original_length)
+        
+        # Caso general: muestra IMU que contiene a cada muestra ECG (aritmética entera)
+        indices = (np.arange(target_length, dtype=np.int64) * original_length) // target_length
         return motion_mask[indices]
     
     def detect_heart_rate(self, ecg_signal, lead_idx=1):
@@ -190,9 +290,10 @@ class SignalProcessor:
         # Distancia mínima: 0.3s (200 BPM máx)
         min_distance = int(0.1 * fs)
         
-        # Normalizar señal
+        # Normalizar señal; la desviación estándar sale del producto punto de la
+        # señal ya centrada (una pasada, sin recalcular la media ni temporales)
         ecg_norm = ecg_trimmed - np.mean(ecg_trimmed)
-        signal_std = np.std(ecg_norm)
+        signal_std = np.sqrt(np.dot(ecg_norm, ecg_norm) / len(ecg_norm)) if len(ecg_norm) > 0 else 0.0
         min_height = signal_std * 3
         
         # Detectar picos (probar normal e invertida)
@@ -219,80 +320,101 @@ class SignalProcessor:
         
         return bpm, r_peaks_original
     
-    def process_ecg_with_motion(self, ecg_data, motion_mask_imu, wavelet_level=4):
-        """Procesa ECG con filtrado adaptativo según movimiento"""
-        n_samples, n_leads = ecg_data.shape
+    def process_ecg_with_motion(self, ecg_data, motion_mask, wavelet_level=4):
+        """
+        Procesa ECG con filtrado adaptativo según movimiento
+        ecg_data: (L, N) - una fila contigua por derivación
+        motion_mask: máscara ya resampleada a tasa ECG (ver resample_motion_mask)
+        """
+        n_leads, n_samples = ecg_data.shape
         filtered = np.zeros_like(ecg_data)
-        preprocessed = np.zeros_like(ecg_data)
         heart_rates = {}
         
-        # Resamplear máscara de movimiento a tasa ECG
-        motion_mask = self.resample_motion_mask(motion_mask_imu, n_samples)
-        
         print(f"[ECG] Procesando {n_leads} derivaciones, {n_samples} muestras @ {self.ecg_sample_rate}Hz")
         
-        # PASO 1: Preprocesamiento (HPF + LPF + Notch)
-        for lead_idx in range(n_leads):
-            lead_name = ['I', 'II', 'III'][lead_idx]
-            signal_raw = ecg_data[:, lead_idx]
-            signal_preprocessed = self.preprocess_ecg(signal_raw)
-            preprocessed[:, lead_idx] = signal_preprocessed
-            print(f"[ECG] Lead {lead_name}: Filtros aplicados")
+        # PASO 1: Preprocesamiento (HPF + LPF + Notch) de todas las derivaciones
+        preprocessed = self.preprocess_ecg(ecg_data).astype(ecg_data.dtype, copy=False)
+        print(f"[ECG] Filtros aplicados a {n_leads} derivaciones")
+        
+        # PASO 2: Filtrado wavelet adaptativo (una descomposición para todo el registro)
+        # Umbral por muestra: 2.0x con movimiento, 1.0x quieto
+        if len(motion_mask) > 0:
+            threshold_scale = np.where(motion_mask, np.float32(2.0), np.float32(1.0))
+        else:
+            # Sin datos IMU: procesar todo como "quieto"
+            threshold_scale = 1.0
+            print("[ECG] Sin datos IMU - procesando sin detección de movimiento")
+        
+        # Registro sin movimiento: saltar derivaciones ya limpias tras el preprocesamiento
+        noisy_leads = np.ones(n_leads, dtype=bool)
+        if n_samples > 100 and not np.any(motion_mask):
+            quick_sigma = np.median(np.abs(np.diff(preprocessed, axis=-1)), axis=-1) / 0.6745
+            noisy_leads = quick_sigma >= NOISE_FLOOR_MV
+            for lead_idx in np.where(~noisy_leads)[0]:
+                print(f"[ECG] Lead {['I', 'II', 'III'][lead_idx]}: ruido {quick_sigma[lead_idx]:.4f} mV < piso, sin filtrado wavelet")
+        
+        if n_samples <= 100 or not noisy_leads.any():
+            filtered[:] = preprocessed
+        elif noisy_leads.all():
+            filtered[:] = self.adaptive_wavelet_filter(preprocessed, level=wavelet_level, threshold_scale=threshold_scale)
+        else:
+            filtered[:] = preprocessed
+            filtered[noisy_leads] = self.adaptive_wavelet_filter(
+                preprocessed[noisy_leads], level=wavelet_level, threshold_scale=threshold_scale
+            )
+        
+        # PASO 3: Detectar BPM (una derivación por hilo)
+        lead_results = list(WORKER_POOL.map(
+            lambda lead_idx: self.detect_heart_rate(filtered[lead_idx], lead_idx),
+            range(n_leads)
+        ))
         
-        # PASO 2: Filtrado wavelet adaptativo
-        for lead_idx in range(n_leads):
+        for lead_idx, (bpm, r_peaks) in enumerate(lead_results):
             lead_name = ['I', 'II', 'III'][lead_idx]
-            sig = preprocessed[:, lead_idx]
-            
-            # Verificar si hay datos de movimiento
-            if len(motion_mask) > 0:
-                motion_indices = np.where(motion_mask)[0]
-                quiet_indices = np.where(~motion_mask)[0]
-            else:
-                # Sin datos IMU: procesar todo como "quieto"
-                motion_indices = np.array([], dtype=int)
-                quiet_indices = np.arange(len(sig))
-                print(f"[ECG] Lead {lead_name}: Sin datos IMU - procesando sin detección de movimiento")
-            
-            # Inicializar con señal preprocesada
-            filtered[:, lead_idx] = sig
-            
-            if len(motion_indices) > 100:
-                motion_signal = sig[motion_indices]
-                filtered_motion = self.adaptive_wavelet_filter(motion_signal, level=wavelet_level, threshold_scale=2.0)
-                filtered[motion_indices, lead_idx] = filtered_motion
-            
-            if len(quiet_indices) > 100:
-                quiet_signal = sig[quiet_indices]
-                filtered_quiet = self.adaptive_wavelet_filter(quiet_signal, level=wavelet_level, threshold_scale=1.0)
-                filtered[quiet_indices, lead_idx] = filtered_quiet
-            
-            # Detectar BPM
-            bpm, r_peaks = self.detect_heart_rate(filtered[:, lead_idx], lead_idx)
             heart_rates[lead_name] = {
                 'bpm': float(bpm),
                 'num_beats': len(r_peaks),
                 'r_peaks': r_peaks.tolist()
             }
         
-        return filtered, preprocessed, heart_rates, motion_mask
+        return filtered, preprocessed, heart_rates
+
+
+def read_s3_body(response):
+    """Lee el cuerpo de un objeto S3 directamente en un bytearray preasignado"""
+    size = response['ContentLength']
+    buf = bytearray(size)
+    view = memoryview(buf)
+    body = response['Body']
+    
+    # StreamingBody solo tiene readinto en botocore recientes: leer por bloques de 1 MB
+    offset = 0
+    while offset < size:
+        chunk = body.read(min(size - offset, 1 << 20))
+        if not chunk:
+            break
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    body.close()
+    
+    if offset < size:
+        raise ValueError(f"Descarga incompleta: {offset} de {size} bytes")
+    
+    return buf
 
 
 def parse_binary_file(file_data):
     """Parsea archivo binario del ESP32 - VERSION SOLO ACELEROMETRO"""
     print(f"[PARSE] Archivo de {len(file_data)} bytes")
     
-    # Header: magic(4) + version(2) + device_id(2) + session_id(4) + timestamp(4) + 
-    # ecg_rate(2) + imu_rate(2) + num_ecg(4) + num_imu(4) = 28 bytes
-    header_format = '<IHHIIHHII'
-    header_size = struct.calcsize(header_format)
+    header_size = HEADER_STRUCT.size
     
     print(f"[PARSE] Tamaño header esperado: {header_size} bytes")
     
     if len(file_data) < header_size:
         raise ValueError(f"Archivo muy pequeño: {len(file_data)} bytes < {header_size} bytes")
     
-    header_data = struct.unpack(header_format, file_data[:header_size])
+    header_data = HEADER_STRUCT.unpack_from(file_data, 0)
     
     header = {
         'magic': header_data[0],
@@ -335,19 +457,25 @@ def parse_binary_file(file_data):
     print(f"[PARSE] ECG: offset {ecg_start}-{ecg_end} ({ecg_size} bytes)")
     print(f"[PARSE] IMU: offset {imu_start}+ ({imu_size} bytes esperados)")
     
-    # Leer ECG
-    ecg_data_raw = np.frombuffer(file_data[ecg_start:ecg_end], dtype=np.int16).reshape(-1, 3)
-    ecg_data = ecg_data_raw.astype(np.float32) / ECG_SCALE_FACTOR
+    # Leer ECG (vista directa sobre el buffer, sin copiar bytes)
+    ecg_count = max(0, min(ecg_end, len(file_data)) - ecg_start) // 2
+    ecg_data_raw = np.frombuffer(file_data, dtype=np.int16, count=ecg_count, offset=ecg_start).reshape(-1, 3)
+    
+    # Layout (3, N): una fila contigua por derivación; la transposición
+    # se hace en la misma pasada que el cast + escala
+    ecg_data = np.empty((3, len(ecg_data_raw)), dtype=np.float32)
+    np.multiply(ecg_data_raw.T, np.float32(1.0 / ECG_SCALE_FACTOR), out=ecg_data)
     print(f"[PARSE] ECG: shape={ecg_data.shape}, rango=[{ecg_data.min():.3f}, {ecg_data.max():.3f}] mV")
     
     # Leer IMU - SOLO ACELEROMETRO (3 valores)
     if header['num_imu_samples'] > 0:
-        imu_raw = np.frombuffer(file_data[imu_start:imu_start + imu_size], dtype=np.int16)
+        imu_count = max(0, min(imu_start + imu_size, len(file_data)) - imu_start) // 2
+        imu_raw = np.frombuffer(file_data, dtype=np.int16, count=imu_count, offset=min(imu_start, len(file_data)))
         n_imu = len(imu_raw) // 3  # 3 valores por muestra (ax, ay, az)
         imu_raw = imu_raw[:n_imu * 3].reshape(-1, 3)
         
-        # Solo acelerómetro
-        imu_data = imu_raw.astype(np.float32) * ACCEL_SCALE
+        # Solo acelerómetro (cast + escala en una sola pasada)
+        imu_data = np.multiply(imu_raw, np.float32(ACCEL_SCALE), dtype=np.float32)
         
         print(f"[PARSE] IMU (Accel): shape={imu_data.shape}")
     else:
@@ -356,94 +484,192 @@ def parse_binary_file(file_data):
         print(f"[PARSE] IMU: Sin datos (shape=(0, 3))")
     
     # Calcular duración
-    duration_ecg = len(ecg_data) / ECG_SAMPLE_RATE_HZ
+    duration_ecg = ecg_data.shape[1] / ECG_SAMPLE_RATE_HZ
     duration_imu = len(imu_data) / IMU_SAMPLE_RATE_HZ if len(imu_data) > 0 else 0
     print(f"[PARSE] Duración ECG: {duration_ecg:.2f}s, IMU: {duration_imu:.2f}s")
     
     return header, ecg_data, imu_data
 
 
-def generate_csv_data(ecg_raw, ecg_filtered, imu_data, motion_mask):
-    """Genera CSV con datos - VERSION SOLO ACELEROMETRO"""
-    output = StringIO()
-    writer = csv.writer(output)
-    
-    # Header
-    writer.writerow([
+def generate_csv_chunks(ecg_raw, ecg_filtered, imu_data, motion_mask, rows_per_chunk=CSV_CHUNK_ROWS):
+    """
+    Genera el CSV por bloques de filas - VERSION SOLO ACELEROMETRO
+    Cada bloque se formatea a partir de las columnas de su rango de filas, sin
+    materializar el archivo completo en memoria
+    """
+    header = ','.join([
         'time_ecg_s', 'ecg_I_raw_mV', 'ecg_II_raw_mV', 'ecg_III_raw_mV',
         'ecg_I_filt_mV', 'ecg_II_filt_mV', 'ecg_III_filt_mV',
         'time_imu_s', 'accel_x_g', 'accel_y_g', 'accel_z_g', 'motion_detected'
     ])
+    yield header + '\r\n'
     
-    n_ecg = len(ecg_raw)
+    n_ecg = ecg_raw.shape[1]
     n_imu = len(imu_data)
-    max_rows = max(n_ecg, n_imu)
-    
-    for i in range(max_rows):
-        row = []
-        
-        # ECG data
-        if i < n_ecg:
-            t_ecg = i / ECG_SAMPLE_RATE_HZ
-            row.extend([
-                f"{t_ecg:.4f}",
-                f"{ecg_raw[i, 0]:.4f}", f"{ecg_raw[i, 1]:.4f}", f"{ecg_raw[i, 2]:.4f}",
-                f"{ecg_filtered[i, 0]:.4f}", f"{ecg_filtered[i, 1]:.4f}", f"{ecg_filtered[i, 2]:.4f}"
-            ])
-        else:
-            row.extend(['', '', '', '', '', '', ''])
-        
-        # IMU data 
-        if i < n_imu:
-            t_imu = i / IMU_SAMPLE_RATE_HZ
-            motion = 1 if i < len(motion_mask) and motion_mask[i] else 0
-            row.extend([
-                f"{t_imu:.4f}",
-                f"{imu_data[i, 0]:.4f}", f"{imu_data[i, 1]:.4f}", f"{imu_data[i, 2]:.4f}",
-                str(motion)
-            ])
-        else:
-            row.extend(['', '', '', '', ''])
+    n_mask = min(len(motion_mask), n_imu)
+    
+    # Un solo formateo por fila; las columnas sin datos quedan vacías
+    ecg_fmt = ','.join(['%.4f'] * 7)
+    imu_fmt = ','.join(['%.4f'] * 4 + ['%d'])
+    
+    for start in range(0, max(n_ecg, n_imu), rows_per_chunk):
+        ecg_end = min(start + rows_per_chunk, n_ecg)
+        imu_end = min(start + rows_per_chunk, n_imu)
+        n_both = max(0, min(ecg_end, imu_end) - start)
+        
+        # Columnas ECG: tiempo + 3 raw + 3 filtradas
+        ecg_cols = np.empty((max(0, ecg_end - start), 7))
+        ecg_cols[:, 0] = np.arange(start, ecg_end) / ECG_SAMPLE_RATE_HZ
+        ecg_cols[:, 1:4] = ecg_raw[:, start:ecg_end].T
+        ecg_cols[:, 4:7] = ecg_filtered[:, start:ecg_end].T
+        
+        # Columnas IMU: tiempo + 3 ejes + movimiento
+        imu_cols = np.zeros((max(0, imu_end - start), 5))
+        imu_cols[:, 0] = np.arange(start, imu_end) / IMU_SAMPLE_RATE_HZ
+        imu_cols[:, 1:4] = imu_data[start:imu_end]
+        mask_end = min(n_mask, imu_end)
+        if start < mask_end:
+            imu_cols[:mask_end - start, 4] = motion_mask[start:mask_end]
+        
+        lines = []
+        both_rows = np.hstack([ecg_cols[:n_both], imu_cols[:n_both]])
+        lines.extend(map((ecg_fmt + ',' + imu_fmt).__mod__, map(tuple, both_rows.tolist())))
+        lines.extend(map((ecg_fmt + ',,,,,').__mod__, map(tuple, ecg_cols[n_both:].tolist())))
+        lines.extend(map((',,,,,,,' + imu_fmt).__mod__, map(tuple, imu_cols[n_both:].tolist())))
+        lines.append('')
+        
+        yield '\r\n'.join(lines)
+
+
+class ChunkedCSV(RawIOBase):
+    """
+    Stream de solo lectura que comprime con gzip los bloques de
+    generate_csv_chunks a medida que se leen (para upload_fileobj)
+    """
+    
+    def __init__(self, chunks, compresslevel=CSV_GZIP_LEVEL):
+        self._chunks = iter(chunks)
+        # wbits=31: formato gzip (header + deflate + CRC32)
+        self._compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 31)
+        self._buffer = bytearray()
+        self._exhausted = False
+    
+    def readable(self):
+        return True
+    
+    def readinto(self, b):
+        while len(self._buffer) < len(b) and not self._exhausted:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                self._buffer += self._compressor.flush()
+                self._exhausted = True
+            else:
+                self._buffer += self._compressor.compress(chunk.encode('utf-8'))
         
-        writer.writerow(row)
-    
-    return output.getvalue()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        del self._buffer[:n]
+        return n
 
 
-def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, heart_rates):
-    """Genera visualizaciones"""
-    n_ecg = len(ecg_filtered)
-    n_imu = len(imu_accel)
-    
-    time_ecg = np.arange(n_ecg) / ECG_SAMPLE_RATE_HZ
-    time_imu = np.arange(n_imu) / IMU_SAMPLE_RATE_HZ if n_imu > 0 else np.array([])
-    
-    # Resamplear motion_mask para ECG
-    if len(motion_mask) > 0 and len(motion_mask) != n_ecg:
-        indices = np.linspace(0, len(motion_mask) - 1, n_ecg).astype(int)
-        motion_mask_ecg = motion_mask[indices]
-    else:
-        motion_mask_ecg = motion_mask if len(motion_mask) > 0 else np.zeros(n_ecg, dtype=bool)
-    
-    plots = {}
-    
-    duration_sec = n_ecg / ECG_SAMPLE_RATE_HZ
-    print(f"[PLOTS] Duración: {duration_sec:.2f}s, ECG: {n_ecg}, IMU: {n_imu}")
-    
-    # ========== PLOT 1: ECG Filtrado ==========
-    fig, axes = plt.subplots(3, 1, figsize=(14, 10))
+def quantize_int16(data):
+    """
+    Cuantiza señal a int16 con escala fija a fondo de escala.
+    Reconstrucción: data ≈ quantized / scale
+    """
+    peak = float(np.abs(data).max()) if data.size > 0 else 0.0
+    scale = 32767.0 / max(peak, 1e-6)
+    quantized = np.round(data * scale).astype(np.int16)
+    return quantized, scale
+
+
+def generate_npz_data(ecg_raw, ecg_filtered_int16, ecg_filtered_scale, imu_data, motion_mask):
+    """
+    Genera NPZ binario comprimido con las señales (ECG filtrado en int16 + máscara empaquetada)
+    Las señales ECG se guardan como (N, 3), igual que en el CSV
+    Reconstrucción: ecg_filtered / ecg_filtered_scale (mV)
+    """
+    buf = BytesIO()
+    np.savez_compressed(
+        buf,
+        ecg_raw=ecg_raw.astype(np.float32, copy=False).T,
+        ecg_filtered=ecg_filtered_int16.T,
+        ecg_filtered_scale=np.float64(ecg_filtered_scale),
+        imu=imu_data.astype(np.float32, copy=False),
+        motion=np.packbits(motion_mask),
+        motion_samples=np.int64(len(motion_mask))
+    )
+    return buf.getvalue()
+
+
+def envelope_decimate(t, y, max_points=PLOT_MAX_POINTS):
+    """
+    Reduce una traza a ~max_points conservando mín/máx de cada bloque,
+    así los picos R no desaparecen al graficar registros largos
+    """
+    n = len(y)
+    stride = int(np.ceil(2 * n / max_points)) if max_points > 0 else 1
+    if stride <= 1:
+        return t, y
+    
+    n_blocks = n // stride
+    m = n_blocks * stride
+    blocks = np.asarray(y[:m]).reshape(n_blocks, stride)
+    
+    t_env = np.repeat(t[:m:stride], 2)
+    y_env = np.column_stack([blocks.min(axis=1), blocks.max(axis=1)]).ravel()
+    
+    return np.concatenate([t_env, t[m:]]), np.concatenate([y_env, y[m:]])
+
+
+def new_figure(**fig_kwargs):
+    """Crea una figura Agg independiente (sin el estado global de pyplot, segura entre hilos)"""
+    # Import diferido: matplotlib solo se carga si el archivo llegó a la etapa de gráficos
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    
+    fig = Figure(**fig_kwargs)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def figure_to_png(fig):
+    """Renderiza la figura a PNG en memoria"""
+    fig.tight_layout()
+    buf = BytesIO()
+    fig.savefig(buf, format='png', dpi=PLOT_DPI)
+    return buf.getvalue()
+
+
+def r_peak_points(time_ecg, ecg_filtered, heart_rates):
+    """Coordenadas (tiempo, amplitud) de los picos R por derivación, calculadas una vez para todos los plots"""
+    points = {}
+    for i, lead_name in enumerate(['I', 'II', 'III']):
+        if lead_name in heart_rates and 'r_peaks' in heart_rates[lead_name]:
+            r_peaks = np.asarray(heart_rates[lead_name]['r_peaks'])
+            if len(r_peaks) > 0:
+                points[lead_name] = (time_ecg[r_peaks], ecg_filtered[i][r_peaks])
+    return points
+
+
+def plot_r_peaks(ax, peak_points, lead_name, s=50):
+    """Marca los picos R detectados de una derivación"""
+    if lead_name in peak_points:
+        ax.scatter(*peak_points[lead_name], 
+                  c='red', s=s, marker='x', linewidths=2, label='R peaks')
+
+
+def plot_ecg_filtered(time_ecg, ecg_filtered, heart_rates, peak_points, duration_sec):
+    """PLOT 1: ECG Filtrado - 3 derivaciones"""
+    fig = new_figure(figsize=(14, 10))
+    axes = fig.subplots(3, 1)
     fig.suptitle(f'ECG Filtrado - 3 Derivaciones ({duration_sec:.1f}s)', fontsize=14, fontweight='bold')
     
     lead_names = ['I', 'II', 'III']
     for i, ax in enumerate(axes):
         lead_name = lead_names[i]
-        ax.plot(time_ecg, ecg_filtered[:, i], color='darkblue', linewidth=0.8)
-        
-        if lead_name in heart_rates and 'r_peaks' in heart_rates[lead_name]:
-            r_peaks = np.array(heart_rates[lead_name]['r_peaks'])
-            if len(r_peaks) > 0:
-                ax.scatter(time_ecg[r_peaks], ecg_filtered[r_peaks, i], 
-                          c='red', s=50, marker='x', linewidths=2, label='R peaks')
+        ax.plot(*envelope_decimate(time_ecg, ecg_filtered[i]), color='darkblue', linewidth=0.8)
+        plot_r_peaks(ax, peak_points, lead_name)
         
         bpm_text = f"{heart_rates[lead_name]['bpm']:.1f} BPM" if lead_name in heart_rates else "N/A"
         ax.set_ylabel(f'{lead_name} (mV)', fontsize=10)
@@ -453,30 +679,23 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
             ax.legend(loc='upper right', fontsize=9)
     
     axes[-1].set_xlabel('Tiempo (s)', fontsize=11)
-    plt.tight_layout()
-    
-    buf = BytesIO()
-    plt.savefig(buf, format='png', dpi=150)
-    buf.seek(0)
-    plots['ecg_filtered.png'] = buf.getvalue()
-    plt.close()
-    
-    # ========== PLOT 2: Comparación Raw vs Filtrado ==========
-    fig, axes = plt.subplots(2, 1, figsize=(14, 8), sharex=True)
+    return figure_to_png(fig)
+
+
+def plot_ecg_comparison(time_ecg, ecg_filtered, ecg_raw, heart_rates, peak_points):
+    """PLOT 2: Comparación Raw vs Filtrado (Lead II)"""
+    fig = new_figure(figsize=(14, 8))
+    axes = fig.subplots(2, 1, sharex=True)
     bpm_ii = heart_rates.get('II', {}).get('bpm', 0)
     fig.suptitle(f'Comparación: ECG Raw vs Filtrado (Lead II) - {bpm_ii:.1f} BPM', fontsize=14, fontweight='bold')
     
-    axes[0].plot(time_ecg, ecg_raw[:, 1], color='gray', linewidth=0.5, alpha=0.7)
+    axes[0].plot(*envelope_decimate(time_ecg, ecg_raw[1]), color='gray', linewidth=0.5, alpha=0.7)
     axes[0].set_ylabel('Raw (mV)', fontsize=10)
     axes[0].grid(True, alpha=0.3)
     axes[0].set_title('Señal Original')
     
-    axes[1].plot(time_ecg, ecg_filtered[:, 1], color='darkgreen', linewidth=0.8)
-    if 'II' in heart_rates and 'r_peaks' in heart_rates['II']:
-        r_peaks = np.array(heart_rates['II']['r_peaks'])
-        if len(r_peaks) > 0:
-            axes[1].scatter(time_ecg[r_peaks], ecg_filtered[r_peaks, 1], 
-                          c='red', s=60, marker='x', linewidths=2, label='R peaks')
+    axes[1].plot(*envelope_decimate(time_ecg, ecg_filtered[1]), color='darkgreen', linewidth=0.8)
+    plot_r_peaks(axes[1], peak_points, 'II', s=60)
     axes[1].set_ylabel('Filtrado (mV)', fontsize=10)
     axes[1].set_xlabel('Tiempo (s)', fontsize=11)
     axes[1].grid(True, alpha=0.3)
@@ -484,25 +703,20 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
     axes[1].legend(loc='upper right', fontsize=9)
     axes[1].set_xlim(0, time_ecg[-1])
     
-    plt.tight_layout()
-    buf = BytesIO()
-    plt.savefig(buf, format='png', dpi=150)
-    buf.seek(0)
-    plots['ecg_comparison.png'] = buf.getvalue()
-    plt.close()
+    return figure_to_png(fig)
+
+
+def plot_dashboard(time_ecg, ecg_filtered, time_imu, imu_accel, motion_mask, metadata, heart_rates, peak_points, duration_sec):
+    """PLOT 3: Dashboard (simplificado si no hay datos IMU)"""
+    avg_bpm = np.mean([hr['bpm'] for hr in heart_rates.values()]) if heart_rates else 0
     
-    # ========== PLOT 3: Dashboard (solo si hay datos IMU) ==========
-    if n_imu > 0:
-        fig = plt.figure(figsize=(16, 10))
+    if len(imu_accel) > 0:
+        fig = new_figure(figsize=(16, 10))
         gs = fig.add_gridspec(4, 1, hspace=0.3)
         
         ax1 = fig.add_subplot(gs[0:2])
-        ax1.plot(time_ecg, ecg_filtered[:, 1], color='darkblue', linewidth=0.8)
-        if 'II' in heart_rates and 'r_peaks' in heart_rates['II']:
-            r_peaks = np.array(heart_rates['II']['r_peaks'])
-            if len(r_peaks) > 0:
-                ax1.scatter(time_ecg[r_peaks], ecg_filtered[r_peaks, 1], 
-                           c='red', s=50, marker='x', linewidths=2, label='R peaks')
+        ax1.plot(*envelope_decimate(time_ecg, ecg_filtered[1]), color='darkblue', linewidth=0.8)
+        plot_r_peaks(ax1, peak_points, 'II')
         bpm_text = f" - {heart_rates.get('II', {}).get('bpm', 0):.1f} BPM"
         ax1.set_title(f'ECG Lead II{bpm_text}', fontsize=12, fontweight='bold')
         ax1.set_ylabel('Amplitud (mV)', fontsize=10)
@@ -511,8 +725,8 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
         ax1.set_xlim(0, time_ecg[-1])
         
         ax2 = fig.add_subplot(gs[2])
-        accel_mag = np.sqrt(np.sum(imu_accel**2, axis=1))
-        ax2.plot(time_imu, accel_mag, color='red', linewidth=0.8)
+        accel_mag = acceleration_magnitude(imu_accel)
+        ax2.plot(*envelope_decimate(time_imu, accel_mag), color='red', linewidth=0.8)
         ax2.set_title('Aceleración Total', fontsize=11)
         ax2.set_ylabel('Magnitud (g)', fontsize=9)
         ax2.set_xlabel('Tiempo (s)', fontsize=9)
@@ -520,7 +734,9 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
         ax2.set_xlim(0, time_imu[-1])
         
         ax3 = fig.add_subplot(gs[3])
-        ax3.fill_between(time_imu, 0, motion_mask.astype(float), color='orange', alpha=0.5)
+        # Vista uint8 de la máscara (sin copia a float64)
+        time_mask, mask_env = envelope_decimate(time_imu, motion_mask.view(np.uint8))
+        ax3.fill_between(time_mask, 0, mask_env, color='orange', alpha=0.5)
         ax3.set_title('Máscara de Movimiento', fontsize=11)
         ax3.set_ylabel('Movimiento', fontsize=9)
         ax3.set_xlabel('Tiempo (s)', fontsize=9)
@@ -529,19 +745,14 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
         ax3.grid(True, alpha=0.3)
         ax3.set_xlim(0, time_imu[-1])
         
-        avg_bpm = np.mean([hr['bpm'] for hr in heart_rates.values()]) if heart_rates else 0
         fig.suptitle(f'Dashboard Holter - {duration_sec:.1f}s - {avg_bpm:.1f} BPM - Mov: {metadata["motion_percentage"]:.1f}%', 
                      fontsize=14, fontweight='bold', y=0.995)
     else:
         # Dashboard simplificado sin IMU
-        fig, ax = plt.subplots(figsize=(14, 6))
-        ax.plot(time_ecg, ecg_filtered[:, 1], color='darkblue', linewidth=0.8)
-        if 'II' in heart_rates and 'r_peaks' in heart_rates['II']:
-            r_peaks = np.array(heart_rates['II']['r_peaks'])
-            if len(r_peaks) > 0:
-                ax.scatter(time_ecg[r_peaks], ecg_filtered[r_peaks, 1], 
-                          c='red', s=50, marker='x', linewidths=2, label='R peaks')
-        avg_bpm = np.mean([hr['bpm'] for hr in heart_rates.values()]) if heart_rates else 0
+        fig = new_figure(figsize=(14, 6))
+        ax = fig.subplots()
+        ax.plot(*envelope_decimate(time_ecg, ecg_filtered[1]), color='darkblue', linewidth=0.8)
+        plot_r_peaks(ax, peak_points, 'II')
         ax.set_title(f'ECG Lead II - {avg_bpm:.1f}', fontsize=14, fontweight='bold')
         ax.set_ylabel('Amplitud (mV)', fontsize=11)
         ax.set_xlabel('Tiempo (s)', fontsize=11)
@@ -549,35 +760,60 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
         ax.legend(loc='upper right')
         ax.set_xlim(0, time_ecg[-1])
     
-    plt.tight_layout()
-    buf = BytesIO()
-    plt.savefig(buf, format='png', dpi=150)
-    buf.seek(0)
-    plots['dashboard.png'] = buf.getvalue()
-    plt.close()
+    return figure_to_png(fig)
+
+
+def plot_imu_accel(time_imu, imu_accel):
+    """PLOT 4: Acelerómetro - 3 ejes"""
+    fig = new_figure(figsize=(14, 8))
+    axes = fig.subplots(3, 1, sharex=True)
+    fig.suptitle('Acelerómetro - 3 Ejes', fontsize=14, fontweight='bold')
+    
+    axis_names = ['X', 'Y', 'Z']
+    colors = ['red', 'green', 'blue']
+    
+    # Un eje por fila contigua (las columnas de (M, 3) son strided y se copiarían al decimar)
+    imu_axes = np.ascontiguousarray(imu_accel.T)
+    for i, ax in enumerate(axes):
+        ax.plot(*envelope_decimate(time_imu, imu_axes[i]), color=colors[i], linewidth=0.8)
+        ax.set_ylabel(f'Accel {axis_names[i]} (g)', fontsize=10)
+        ax.grid(True, alpha=0.3)
+    
+    axes[-1].set_xlabel('Tiempo (s)', fontsize=11)
+    axes[-1].set_xlim(0, time_imu[-1])
+    return figure_to_png(fig)
+
+
+def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, heart_rates):
+    """Genera visualizaciones (cada figura se renderiza en su propio hilo)"""
+    import matplotlib
+    matplotlib.rcParams['path.simplify'] = True
+    matplotlib.rcParams['path.simplify_threshold'] = 1.0
+    matplotlib.rcParams['agg.path.chunksize'] = 10000
+    
+    n_ecg = ecg_filtered.shape[1]
+    n_imu = len(imu_accel)
+    
+    # Ejes de tiempo en float32 (mitad de memoria en las copias internas de matplotlib)
+    time_ecg = np.arange(n_ecg, dtype=np.float32) * np.float32(1.0 / ECG_SAMPLE_RATE_HZ)
+    time_imu = np.arange(n_imu, dtype=np.float32) * np.float32(1.0 / IMU_SAMPLE_RATE_HZ)
+    peak_points = r_peak_points(time_ecg, ecg_filtered, heart_rates)
     
-    # ========== PLOT 4: IMU Acelerómetro (solo si hay datos) ==========
+    duration_sec = n_ecg / ECG_SAMPLE_RATE_HZ
+    print(f"[PLOTS] Duración: {duration_sec:.2f}s, ECG: {n_ecg}, IMU: {n_imu}")
+    
+    futures = {
+        'ecg_filtered.png': WORKER_POOL.submit(plot_ecg_filtered, time_ecg, ecg_filtered, heart_rates, peak_points, duration_sec),
+        'ecg_comparison.png': WORKER_POOL.submit(plot_ecg_comparison, time_ecg, ecg_filtered, ecg_raw, heart_rates, peak_points),
+        'dashboard.png': WORKER_POOL.submit(
+            plot_dashboard, time_ecg, ecg_filtered, time_imu, imu_accel,
+            motion_mask, metadata, heart_rates, peak_points, duration_sec
+        ),
+    }
     if n_imu > 0:
-        fig, axes = plt.subplots(3, 1, figsize=(14, 8), sharex=True)
-        fig.suptitle('Acelerómetro - 3 Ejes', fontsize=14, fontweight='bold')
-        
-        axis_names = ['X', 'Y', 'Z']
-        colors = ['red', 'green', 'blue']
-        
-        for i, ax in enumerate(axes):
-            ax.plot(time_imu, imu_accel[:, i], color=colors[i], linewidth=0.8)
-            ax.set_ylabel(f'Accel {axis_names[i]} (g)', fontsize=10)
-            ax.grid(True, alpha=0.3)
-        
-        axes[-1].set_xlabel('Tiempo (s)', fontsize=11)
-        axes[-1].set_xlim(0, time_imu[-1])
-        plt.tight_layout()
-        
-        buf = BytesIO()
-        plt.savefig(buf, format='png', dpi=150)
-        buf.seek(0)
-        plots['imu_accel.png'] = buf.getvalue()
-        plt.close()
+        futures['imu_accel.png'] = WORKER_POOL.submit(plot_imu_accel, time_imu, imu_accel)
+    
+    plots = {filename: future.result() for filename, future in futures.items()}
     
     print(f"[PLOTS] Generadas {len(plots)} imágenes")
     return plots
@@ -585,7 +821,7 @@ def generate_plots(ecg_filtered, ecg_raw, imu_accel, motion_mask, metadata, hear
 
 def lambda_handler(event, context):
     """Handler principal"""
-    print(f"[INFO] Event: {json.dumps(event, indent=2)}")
+    logger.info("Event: %s", event)
     
     try:
         record = event['Records'][0]
@@ -596,7 +832,7 @@ def lambda_handler(event, context):
         
         # Descargar
         response = s3_client.get_object(Bucket=bucket_name, Key=object_key)
-        file_data = response['Body'].read()
+        file_data = read_s3_body(response)
         print(f"[INFO] Descargado: {len(file_data) / 1024:.2f} KB")
         
         # Parsear
@@ -609,35 +845,42 @@ def lambda_handler(event, context):
         if len(imu_data) > 0:
             accel_data = imu_data  # Ya es solo acelerómetro (3 columnas)
             motion_mask_imu = processor.detect_motion_segments(accel_data)
-            motion_percentage = (motion_mask_imu.sum() / len(motion_mask_imu)) * 100 if len(motion_mask_imu) > 0 else 0
+            motion_percentage = (np.count_nonzero(motion_mask_imu) / len(motion_mask_imu)) * 100 if len(motion_mask_imu) > 0 else 0
         else:
             motion_mask_imu = np.array([], dtype=bool)
             motion_percentage = 0
             print("[INFO] Sin datos IMU")
         
+        # Resamplear máscara de movimiento a tasa ECG (una sola vez)
+        motion_mask_ecg = processor.resample_motion_mask(motion_mask_imu, ecg_data.shape[1])
+        
         # Procesar ECG
         print("[INFO] Procesando ECG...")
-        ecg_filtered, ecg_preprocessed, heart_rates, motion_mask_ecg = processor.process_ecg_with_motion(
-            ecg_data, motion_mask_imu
+        ecg_filtered, ecg_preprocessed, heart_rates = processor.process_ecg_with_motion(
+            ecg_data, motion_mask_ecg
         )
         
+        # Cuantizar ECG filtrado para exportación binaria
+        ecg_filtered_int16, ecg_filtered_scale = quantize_int16(ecg_filtered)
+        
         # BPM promedio
         avg_bpm = np.mean([hr['bpm'] for hr in heart_rates.values()]) if heart_rates else 0
         
         # Metadata
-        duration_sec = len(ecg_data) / ECG_SAMPLE_RATE_HZ
+        duration_sec = ecg_data.shape[1] / ECG_SAMPLE_RATE_HZ
         metadata = {
             'processing_timestamp': datetime.utcnow().isoformat(),
             'source_file': object_key,
             'duration_seconds': float(duration_sec),
             'motion_percentage': float(motion_percentage),
-            'ecg_samples': int(len(ecg_filtered)),
+            'ecg_samples': int(ecg_filtered.shape[1]),
             'imu_samples': int(len(imu_data)),
             'ecg_sample_rate_hz': ECG_SAMPLE_RATE_HZ,
             'imu_sample_rate_hz': IMU_SAMPLE_RATE_HZ,
             'header_ecg_rate': header['ecg_sample_rate_raw'],
             'header_imu_rate': header['imu_sample_rate_raw'],
             'imu_mode': 'accelerometer_only',
+            'ecg_filtered_int16_scale': float(ecg_filtered_scale),
             'heart_rate': {
                 'average_bpm': float(avg_bpm),
                 'lead_I': heart_rates.get('I', {}),
@@ -651,49 +894,75 @@ def lambda_handler(event, context):
         for lead, hr in heart_rates.items():
             print(f"[RESULTS] Lead {lead}: {hr['bpm']:.1f} BPM ({hr['num_beats']} latidos)")
         
-        # Generar plots
-        print("[INFO] Generando visualizaciones...")
-        plots = generate_plots(
-            ecg_filtered, ecg_data, imu_data, 
-            motion_mask_imu, metadata, heart_rates
-        )
-        
-        # Generar CSV con datos
-        print("[INFO] Generando CSV...")
-        csv_data = generate_csv_data(ecg_data, ecg_filtered, imu_data, motion_mask_imu)
-        
         # Base path
         base_key = object_key.replace('raw/', 'processed/').replace('.bin', '')
         
         uploaded_files = []
         
-        # Subir imágenes
-        for filename, image_data in plots.items():
-            output_key = f"{base_key}_{filename}"
-            s3_client.put_object(
-                Bucket=OUTPUT_BUCKET, Key=output_key,
-                Body=image_data, ContentType='image/png'
+        # Las subidas a S3 corren en paralelo y en segundo plano mientras se generan
+        # los siguientes archivos (el cliente S3 es thread-safe)
+        pending_uploads = []
+        
+        def submit_upload(key, body, content_type, **extra_args):
+            future = UPLOAD_POOL.submit(
+                s3_client.put_object,
+                Bucket=OUTPUT_BUCKET, Key=key,
+                Body=body, ContentType=content_type, **extra_args
             )
-            uploaded_files.append(output_key)
-            print(f"[SUCCESS] {output_key}")
-        
-        # Subir CSV
-        csv_key = f"{base_key}_signals.csv"
-        s3_client.put_object(
-            Bucket=OUTPUT_BUCKET, Key=csv_key,
-            Body=csv_data.encode('utf-8'), ContentType='text/csv'
-        )
-        uploaded_files.append(csv_key)
-        print(f"[SUCCESS] {csv_key}")
-        
-        # Subir metadata JSON
-        metadata_key = f"{base_key}_metadata.json"
-        s3_client.put_object(
-            Bucket=OUTPUT_BUCKET, Key=metadata_key,
-            Body=json.dumps(metadata, indent=2), ContentType='application/json'
-        )
-        uploaded_files.append(metadata_key)
-        print(f"[SUCCESS] {metadata_key}")
+            pending_uploads.append((key, future))
+        
+        try:
+            # CSV primero: se genera y comprime por bloques en el pool de subidas (multipart)
+            # mientras el hilo principal renderiza los gráficos
+            print("[INFO] Generando CSV...")
+            csv_key = f"{base_key}_signals.csv.gz"
+            csv_stream = ChunkedCSV(generate_csv_chunks(ecg_data, ecg_filtered, imu_data, motion_mask_imu))
+            pending_uploads.append((csv_key, UPLOAD_POOL.submit(
+                s3_client.upload_fileobj, csv_stream, OUTPUT_BUCKET, csv_key,
+                ExtraArgs={'ContentType': 'application/gzip'}, Config=CSV_TRANSFER_CONFIG
+            )))
+            
+            # Generar plots y subir imágenes
+            print("[INFO] Generando visualizaciones...")
+            plots = generate_plots(
+                ecg_filtered, ecg_data, imu_data, 
+                motion_mask_imu, metadata, heart_rates
+            )
+            for filename, image_data in plots.items():
+                submit_upload(f"{base_key}_{filename}", image_data, 'image/png')
+            
+            # Generar NPZ binario
+            npz_data = generate_npz_data(
+                ecg_data, ecg_filtered_int16, ecg_filtered_scale, imu_data, motion_mask_imu
+            )
+            submit_upload(f"{base_key}_signals.npz", npz_data, 'application/octet-stream')
+            
+            # Metadata JSON
+            submit_upload(
+                f"{base_key}_metadata.json",
+                json.dumps(metadata, indent=2).encode('utf-8'),
+                'application/json'
+            )
+            
+            for output_key, future in pending_uploads:
+                future.result()
+                uploaded_files.append(output_key)
+                print(f"[SUCCESS] {output_key}")
+        except Exception:
+            # El pool sobrevive a la invocación: ante un error, esperar las subidas en curso
+            # y borrar las que terminaron, para no dejar artefactos parciales tras un 500
+            wait([future for _, future in pending_uploads])
+            written = [
+                {'Key': key} for key, future in pending_uploads
+                if future.exception() is None
+            ]
+            if written:
+                try:
+                    s3_client.delete_objects(Bucket=OUTPUT_BUCKET, Delete={'Objects': written, 'Quiet': True})
+                    print(f"[CLEANUP] {len(written)} archivos parciales eliminados")
+                except Exception as cleanup_error:
+                    print(f"[CLEANUP] No se pudieron eliminar archivos parciales: {cleanup_error}")
+            raise
         
         return {
             'statusCode': 200,